@@ -1,14 +1,94 @@
 # SPDX-License-Identifier: BSD-3-Clause
 
 import collections
-import importlib
+import functools
+import hashlib
 import os
-import traceback
+import pickle
+import sys
+import tempfile
 import yaml
 
 
-# To be loaded dynamically as needed
-jsonschema = None
+# Use the libyaml-backed loader when available, it's much faster
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+class _SpecLoader(Loader):
+    """Loader which interns keys and names
+
+    Keys and names of the spec are used for dict lookups all the time,
+    interned strings let the lookups match on identity. Text (docs)
+    is left alone.
+    """
+    def construct_yaml_str(self, node):
+        value = self.construct_scalar(node)
+        if ' ' not in value:
+            value = sys.intern(value)
+        return value
+
+
+_SpecLoader.add_constructor('tag:yaml.org,2002:str', _SpecLoader.construct_yaml_str)
+
+try:
+    import jsonschema
+    from jsonschema import Draft7Validator
+except ImportError:
+    # Only needed for validation
+    jsonschema = None
+
+# Families returned by SpecFamily.load(), indexed by class, spec and schema path,
+# along with the mtime and size of the spec file they were loaded from
+_FAMILY_CACHE = {}
+
+
+class _ReleasedSpec:
+    """Stand-in for the raw spec of elements loaded with retain_yaml=False
+
+    Any access fails loudly, rather than answering as if the spec was empty.
+    It has no state and no mutating methods, so it's safe to share.
+    """
+    __slots__ = ()
+
+    def _not_retained(self, key=None, *args):
+        what = f" '{key}'" if key is not None else ''
+        raise KeyError(f"raw spec not retained (retain_yaml=False), can't look up{what}")
+
+    __getitem__ = __contains__ = get = _not_retained
+    __iter__ = __len__ = keys = items = values = _not_retained
+
+
+_RELEASED_SPEC = _ReleasedSpec()
+
+
+def _default_schema_path(spec_path, proto):
+    return os.path.dirname(os.path.dirname(spec_path)) + f'/{proto}.yaml'
+
+
+def _schema_key(schema_path):
+    # None (default schema) and '' (no validation) are kept as they are
+    return os.path.realpath(schema_path) if schema_path else schema_path
+
+
+def _load_yaml(path):
+    # Feed the parser raw bytes, libyaml decodes UTF-8 itself; unlike
+    # a mapping this works for pipes too and keeps the name for errors
+    with open(path, "rb") as f:
+        return yaml.load(f, Loader=_SpecLoader)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_validator(schema_path):
+    # Compile the schema once, all families using it share the validator.
+    # The draft is picked based on $schema, no format checker is attached.
+    if jsonschema is None:
+        raise ImportError("jsonschema is required to validate the spec "
+                          "(skip validation with YNL_SKIP_VALIDATE=1)")
+
+    schema = _load_yaml(schema_path)
+    validator_cls = jsonschema.validators.validator_for(schema, default=Draft7Validator)
+    validator_cls.check_schema(schema)
+    return validator_cls(schema)
 
 
 class SpecElement:
@@ -29,8 +109,10 @@ class SpecElement:
         name        name of the entity as listed in the spec (optional)
         ident_name  name which can be safely used as identifier in code (optional)
     """
-    def __init__(self, family, yaml):
-        self.yaml = yaml
+    __slots__ = ('yaml', 'family', 'name', 'ident_name', '_super_resolved')
+
+    def __init__(self, family, spec):
+        self.yaml = spec
         self.family = family
 
         if 'name' in self.yaml:
@@ -49,6 +131,17 @@ class SpecElement:
     def get(self, key, default=None):
         return self.yaml.get(key, default)
 
+    def dependencies(self):
+        """Elements which have to be resolved before this one.
+
+        Return None if unknown, resolve() will then be retried until
+        can_resolve() says the element is ready.
+        """
+        return None
+
+    def can_resolve(self):
+        return True
+
     def resolve_up(self, up):
         if not self._super_resolved:
             up.resolve()
@@ -67,12 +160,17 @@ class SpecAttr(SpecElement):
         value      numerical ID when serialized
         attr_set   Attribute Set containing this attr
     """
-    def __init__(self, family, attr_set, yaml, value):
-        super().__init__(family, yaml)
+    __slots__ = ('value', 'attr_set', 'is_multi')
+
+    def __init__(self, family, attr_set, spec, value):
+        super().__init__(family, spec)
 
         self.value = value
         self.attr_set = attr_set
-        self.is_multi = yaml.get('multi-attr', False)
+        self.is_multi = spec.get('multi-attr', False)
+
+    def dependencies(self):
+        return set()
 
 
 class SpecAttrSet(SpecElement):
@@ -88,27 +186,32 @@ class SpecAttrSet(SpecElement):
         attrs_by_val  ordered dict of all attributes (indexed by value)
         subset_of  parent set if this is a subset, otherwise None
     """
-    def __init__(self, family, yaml):
-        super().__init__(family, yaml)
+    __slots__ = ('subset_of', 'attrs', 'attrs_by_val')
+
+    def __init__(self, family, spec):
+        super().__init__(family, spec)
 
         self.subset_of = self.yaml.get('subset-of', None)
 
-        self.attrs = collections.OrderedDict()
-        self.attrs_by_val = collections.OrderedDict()
+        attrs = self.attrs = {}
+        attrs_by_val = self.attrs_by_val = {}
+        new_attr = self.new_attr
 
         val = 0
-        for elem in self.yaml['attributes']:
-            if 'value' in elem:
-                val = elem['value']
+        for elem in spec['attributes']:
+            val = elem.get('value', val)
 
-            attr = self.new_attr(elem, val)
-            self.attrs[attr.name] = attr
-            self.attrs_by_val[attr.value] = attr
+            attr = new_attr(elem, val)
+            attrs[attr.name] = attr
+            attrs_by_val[val] = attr
             val += 1
 
     def new_attr(self, elem, value):
         return SpecAttr(self.family, self, elem, value)
 
+    def dependencies(self):
+        return set()
+
     def __getitem__(self, key):
         return self.attrs[key]
 
@@ -122,6 +225,11 @@ class SpecAttrSet(SpecElement):
         return self.attrs.items()
 
 
+# Keys which make an operation a call or a notification
+_CALL_KEYS = frozenset(('do', 'dump'))
+_ASYNC_KEYS = frozenset(('notify', 'event'))
+
+
 class SpecOperation(SpecElement):
     """Netlink Operation
 
@@ -139,33 +247,55 @@ class SpecOperation(SpecElement):
 
         yaml        raw spec as loaded from the spec file
     """
-    def __init__(self, family, yaml, req_value, rsp_value):
-        super().__init__(family, yaml)
+    __slots__ = ('value', 'req_value', 'rsp_value', 'is_call', 'is_async', 'is_resv',
+                 'attr_set')
+
+    def __init__(self, family, spec, req_value, rsp_value):
+        super().__init__(family, spec)
 
         self.value = req_value if req_value == rsp_value else None
         self.req_value = req_value
         self.rsp_value = rsp_value
 
-        self.is_call = 'do' in yaml or 'dump' in yaml
-        self.is_async = 'notify' in yaml or 'event' in yaml
-        self.is_resv = not self.is_async and not self.is_call
-
-        # Added by resolve:
-        self.attr_set = None
-        delattr(self, "attr_set")
+        keys = spec.keys()
+        self.is_call = not _CALL_KEYS.isdisjoint(keys)
+        self.is_async = not _ASYNC_KEYS.isdisjoint(keys)
+        self.is_resv = not (self.is_call or self.is_async)
+
+        # attr_set is added by resolve()
+
+    def _attr_set_source(self):
+        # Where resolve() takes the attribute set from: (dict, key) or (None, None)
+        spec = self.yaml
+        attr_set_name = spec.get('attribute-set')
+        if attr_set_name is not None:
+            return self.family.attr_sets, attr_set_name
+        notify = spec.get('notify')
+        if notify is not None:
+            return self.family.msgs, notify
+        return None, None
+
+    def dependencies(self):
+        source, key = self._attr_set_source()
+        dep = source.get(key) if source is not None else None
+        return {dep} if dep is not None else set()
+
+    def can_resolve(self):
+        # Only consulted by subclasses which don't report dependencies()
+        source, key = self._attr_set_source()
+        return source is None or key in source
 
     def resolve(self):
-        self.resolve_up(super())
-
-        if 'attribute-set' in self.yaml:
-            attr_set_name = self.yaml['attribute-set']
-        elif 'notify' in self.yaml:
-            msg = self.family.msgs[self.yaml['notify']]
-            attr_set_name = msg['attribute-set']
-        elif self.is_resv:
-            attr_set_name = ''
-        else:
-            raise Exception(f"Can't resolve attribute set for op '{self.name}'")
+        spec = self.yaml
+        attr_set_name = spec.get('attribute-set')
+        if attr_set_name is None:
+            if 'notify' in spec:
+                msg = self.family.msgs[spec['notify']]
+                attr_set_name = msg['attribute-set']
+            elif self.is_resv:
+                attr_set_name = ''
+            else:
+                raise Exception(f"Can't resolve attribute set for op '{self.name}'")
         if attr_set_name:
             self.attr_set = self.family.attr_sets[attr_set_name]
 
@@ -180,6 +310,17 @@ class SpecFamily(SpecElement):
     The class can be used like a dictionary to access the raw spec
     elements but that's usually a bad idea.
 
+    The spec is validated against its schema, unless validate=False
+    is passed or YNL_SKIP_VALIDATE=1 is set in the environment. Validation
+    walks the entire spec, so tools which load specs already checked
+    (e.g. by the build) may skip it, CI should always validate.
+
+    With retain_yaml=False the raw spec of attribute sets, attributes and
+    messages is dropped once everything is resolved, and so are the lists
+    of attribute sets and operations from the family's own raw spec.
+    Accessing the raw spec of those elements ([], 'in', get()) raises
+    a KeyError.
+
     Attributes:
         proto     protocol type (e.g. genetlink)
 
@@ -188,9 +329,11 @@ class SpecFamily(SpecElement):
         msgs_by_value  dict of all messages (indexed by name)
         ops        dict of all valid requests / responses
     """
-    def __init__(self, spec_path, schema_path=None):
-        with open(spec_path, "r") as stream:
-            spec = yaml.safe_load(stream)
+    __slots__ = ('_resolution_list', 'proto', 'attr_sets', 'msgs', 'req_by_value',
+                 'rsp_by_value', 'ops')
+
+    def __init__(self, spec_path, schema_path=None, *, validate=True, retain_yaml=True):
+        spec = _load_yaml(spec_path)
 
         self._resolution_list = []
 
@@ -198,44 +341,201 @@ class SpecFamily(SpecElement):
 
         self.proto = self.yaml.get('protocol', 'genetlink')
 
-        if schema_path is None:
-            schema_path = os.path.dirname(os.path.dirname(spec_path)) + f'/{self.proto}.yaml'
-        if schema_path:
-            global jsonschema
-
-            with open(schema_path, "r") as stream:
-                schema = yaml.safe_load(stream)
-
-            if jsonschema is None:
-                jsonschema = importlib.import_module("jsonschema")
-
-            jsonschema.validate(self.yaml, schema)
+        if os.environ.get('YNL_SKIP_VALIDATE') == '1':
+            validate = False
 
-        self.attr_sets = collections.OrderedDict()
-        self.msgs = collections.OrderedDict()
-        self.req_by_value = collections.OrderedDict()
-        self.rsp_by_value = collections.OrderedDict()
-        self.ops = collections.OrderedDict()
-
-        last_exception = None
-        while len(self._resolution_list) > 0:
-            resolved = []
-            unresolved = self._resolution_list
+        if schema_path is None:
+            schema_path = _default_schema_path(spec_path, self.proto)
+        if validate and schema_path:
+            error = next(_get_validator(schema_path).iter_errors(self.yaml), None)
+            if error is not None:
+                raise error
+
+        self.attr_sets = {}
+        self.msgs = {}
+        self.req_by_value = {}
+        self.rsp_by_value = {}
+        self.ops = {}
+
+        self._resolve_all()
+
+        if not retain_yaml:
+            self._release_yaml()
+
+    @classmethod
+    def _create(cls, spec_path, schema_path=None, **kwargs):
+        # Subclasses may take fewer arguments (the code generator's Family
+        # only takes the spec path), pass only what the caller asked for
+        if schema_path is None:
+            return cls(spec_path, **kwargs)
+        return cls(spec_path, schema_path, **kwargs)
+
+    @classmethod
+    def load(cls, spec_path, schema_path=None):
+        """Get a family for spec_path, reusing an earlier instance.
+
+        The instance is shared by all callers loading the same, unchanged
+        file (same path, mtime and size), so it must not be modified.
+        Instantiate the class directly to get a private copy.
+        """
+        path = os.path.realpath(spec_path)
+        st = os.stat(path)
+        key = (cls, path, _schema_key(schema_path))
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        cached = _FAMILY_CACHE.get(key)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, cls._create(spec_path, schema_path))
+            _FAMILY_CACHE[key] = cached
+        return cached[1]
+
+    @classmethod
+    def load_cached(cls, spec_path, schema_path=None, cache_dir=None, *,
+                    validate=True, retain_yaml=True):
+        """Get a family for spec_path, going through an on-disk cache.
+
+        The fully resolved family is pickled into cache_dir (__pycache__
+        next to the spec by default) and loaded from there for as long as
+        neither the spec file, the schema it was validated against, nor
+        the code defining the family changes. Families which can't be
+        pickled (e.g. holding a socket) are simply not cached.
+
+        validate and retain_yaml are passed to the constructor only when
+        they differ from the defaults, so subclasses with a narrower
+        constructor keep working as long as the defaults are used.
+        """
+        path = os.path.realpath(spec_path)
+        st = os.stat(path)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(path), '__pycache__')
+
+        kwargs = {}
+        if not validate:
+            kwargs['validate'] = False
+        if not retain_yaml:
+            kwargs['retain_yaml'] = False
+        validated = validate and os.environ.get('YNL_SKIP_VALIDATE') != '1'
+
+        key = (f'{cls.__module__}.{cls.__qualname__}:{path}:{_schema_key(schema_path)}:'
+               f'{validated}:{retain_yaml}')
+        digest = hashlib.blake2b(key.encode()).hexdigest()[:16]
+        cache_path = os.path.join(cache_dir, f'{os.path.basename(path)}.{digest}.pkl')
+
+        stamp = [st.st_mtime_ns, st.st_size]
+        for code in {__file__, getattr(sys.modules.get(cls.__module__), '__file__', None)}:
+            if code:
+                stamp.append(os.stat(code).st_mtime_ns)
+
+        def schema_stamp(family):
+            # The default schema depends on the protocol, known only after load
+            schema = schema_path
+            if schema is None:
+                schema = _default_schema_path(spec_path, family.proto)
+            if not validated or not schema:
+                return None
+            return os.stat(schema).st_mtime_ns
+
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_stamp, cached_schema_stamp, family = pickle.load(f)
+            if cached_stamp == stamp and isinstance(family, cls) and \
+               cached_schema_stamp == schema_stamp(family):
+                return family
+        except Exception:
+            # Missing, stale or corrupted, just load from scratch
+            pass
+
+        family = cls._create(spec_path, schema_path, **kwargs)
+
+        tmp_path = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as f:
+                tmp_path = f.name
+                pickle.dump((stamp, schema_stamp(family), family), f, protocol=5)
+            os.replace(tmp_path, cache_path)
+        except (OSError, TypeError, pickle.PicklingError, AttributeError):
+            if tmp_path:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+        return family
+
+    def _release_yaml(self):
+        for attr_set in self.attr_sets.values():
+            for attr in attr_set.attrs.values():
+                attr.yaml = _RELEASED_SPEC
+            attr_set.yaml = _RELEASED_SPEC
+        for msg in self.msgs.values():
+            msg.yaml = _RELEASED_SPEC
+
+        # Our own raw spec still references the same subtrees
+        del self.yaml['attribute-sets']
+        del self.yaml['operations']['list']
+
+    def _resolve_all(self):
+        """Resolve all elements in dependency order (Kahn's algorithm).
+
+        Elements get added to the graph as they are instantiated (mostly
+        during resolution of their parents). Elements which don't know
+        their dependencies are retried until they can be resolved.
+        """
+        ready = collections.deque()
+        retry = []
+        resolved = set()
+        in_degree = {}
+        dependents = collections.defaultdict(list)
+
+        def done(elem):
+            resolved.add(elem)
+            for dependent in dependents.pop(elem, []):
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    del in_degree[dependent]
+                    ready.append(dependent)
+
+        while self._resolution_list or ready or retry:
+            new = self._resolution_list
             self._resolution_list = []
+            for elem in new:
+                deps = elem.dependencies()
+                if deps is None:
+                    retry.append(elem)
+                    continue
 
+                deps = [dep for dep in deps if dep is not elem and dep not in resolved]
+                if not deps:
+                    ready.append(elem)
+                    continue
+                in_degree[elem] = len(deps)
+                for dep in deps:
+                    dependents[dep].append(elem)
+
+            if ready:
+                elem = ready.popleft()
+                elem.resolve()
+                done(elem)
+                continue
+            if not retry:
+                continue
+
+            unresolved = retry
+            retry = []
             for elem in unresolved:
-                try:
-                    elem.resolve()
-                except (KeyError, AttributeError) as e:
-                    self._resolution_list.append(elem)
-                    last_exception = e
+                if not elem.can_resolve():
+                    retry.append(elem)
                     continue
 
-                resolved.append(elem)
+                elem.resolve()
+                done(elem)
+
+            if len(retry) == len(unresolved) and not self._resolution_list:
+                names = ', '.join(elem.get('name', '?') for elem in retry)
+                raise Exception(f"Could not resolve any spec element ({names}), infinite loop?")
 
-            if len(resolved) == 0:
-                traceback.print_exception(last_exception)
-                raise Exception("Could not resolve any spec element, infinite loop?")
+        if in_degree:
+            raise Exception("Could not resolve any spec element, dependency loop?")
 
     def new_attr_set(self, elem):
         return SpecAttrSet(self, elem)
@@ -243,6 +543,9 @@ class SpecFamily(SpecElement):
     def new_operation(self, elem, req_val, rsp_val):
         return SpecOperation(self, elem, req_val, rsp_val)
 
+    def dependencies(self):
+        return set()
+
     def add_unresolved(self, elem):
         self._resolution_list.append(elem)
 
@@ -258,39 +561,43 @@ class SpecFamily(SpecElement):
             self.msgs[op.name] = op
 
     def _dictify_ops_directional(self):
+        msgs = self.msgs
+        new_operation = self.new_operation
+
         req_val = rsp_val = 0
         for elem in self.yaml['operations']['list']:
             if 'notify' in elem:
-                if 'value' in elem:
-                    rsp_val = elem['value']
+                rsp_val = elem.get('value', rsp_val)
                 req_val_next = req_val
                 rsp_val_next = rsp_val + 1
                 req_val = None
-            elif 'do' in elem or 'dump' in elem:
-                mode = elem['do'] if 'do' in elem else elem['dump']
-
-                v = mode.get('request', {}).get('value', None)
+            else:
+                mode = elem.get('do')
+                if mode is None:
+                    mode = elem.get('dump')
+                if mode is None:
+                    raise Exception("Can't parse directional ops")
+
+                request = mode.get('request')
+                v = request.get('value') if request else None
                 if v:
                     req_val = v
-                v = mode.get('reply', {}).get('value', None)
+                reply = mode.get('reply')
+                v = reply.get('value') if reply else None
                 if v:
                     rsp_val = v
 
                 rsp_inc = 1 if 'reply' in mode else 0
                 req_val_next = req_val + 1
                 rsp_val_next = rsp_val + rsp_inc
-            else:
-                raise Exception("Can't parse directional ops")
 
-            op = self.new_operation(elem, req_val, rsp_val)
+            op = new_operation(elem, req_val, rsp_val)
             req_val = req_val_next
             rsp_val = rsp_val_next
 
-            self.msgs[op.name] = op
+            msgs[op.name] = op
 
     def resolve(self):
-        self.resolve_up(super())
-
         for elem in self.yaml['attribute-sets']:
             attr_set = self.new_attr_set(elem)
             self.attr_sets[elem['name']] = attr_set